@@ -1,24 +1,59 @@
+import ctypes
 import math
 import os
+import re
+import shutil
+import socket
+import sqlite3
 import subprocess
 import sys
+import threading
+import time
 import timeit
 from argparse import ArgumentParser, RawDescriptionHelpFormatter
-from concurrent.futures import ProcessPoolExecutor, Future
-from datetime import datetime
+from collections import deque
+from concurrent.futures import FIRST_COMPLETED, Future, ThreadPoolExecutor, as_completed, wait
+from contextlib import nullcontext
 from enum import Enum
-from io import BytesIO
+from functools import cache
 from pathlib import Path
 import textwrap
-from statistics import mean
-from typing import Iterable
+from tempfile import TemporaryDirectory, TemporaryFile
+from typing import IO, Iterable, Iterator
+from urllib.request import urlopen
 from zipfile import ZipFile
 
-import requests
-from pymediainfo import MediaInfo
+from pymediainfo import MediaInfo  # type: ignore[import-untyped, unused-ignore]
+
+try:
+    from libmediainfo_cffi import MediaInfo as LibMediaInfo  # type: ignore[import-not-found, import-untyped, unused-ignore]
+except ImportError:
+    LibMediaInfo = None
 
 MILLISEC_TO_MIN = 60000
 FATAL_ERROR = 127
+MEDIAINFO_BATCH = 50
+WALK_WORKERS = 8
+STDERR_LINES = 200
+# seconds between progress lines of a running encode
+PROGRESS_INTERVAL = 60
+# seconds after which a lock's .break guard is taken over, a live process holds it for well under a second
+LOCK_GUARD_TIMEOUT = 60
+# HandBrake prints 'Encoding: task 1 of 1, 42.13 %', ffmpeg -progress prints 'out_time_us=...'
+PROGRESS_RE = re.compile(rb'task \d+ of \d+, (\d+\.\d+) %|out_time_us=(\d+)')
+FFMPEG_BITRATE = '6M'
+# '1080p30' in a preset name caps the height at 1080 and the frame rate at 30
+PRESET_SIZE_RE = re.compile(r'(\d+)p(\d+)?\b')
+# disc images are always DVD MPEG-2 and always need transcoding, so they are never probed for the format check
+DISC_IMAGE_EXTENSIONS = frozenset({'iso', 'img'})
+# video format each preset produces, sources already in that format are skipped
+PRESET_FORMATS = {'H.265 VCN 1080p': 'HEVC', 'Fast 1080p30': 'AVC'}
+# relative cost of decoding each source format, used to estimate encode time for the LPT sort
+FORMAT_COMPLEXITY = {'HEVC': 2.0, 'AVC': 1.0}
+MEDIAINFO_TEMPLATE = 'Video;%Format%|%Format_Profile%|%Duration%\\n'
+# the batch output starts a line with each file's path, followed by |format|profile|duration per video track
+MEDIAINFO_BATCH_TEMPLATE = 'General;\\n%CompleteName%\r\nVideo;|%Format%|%Format_Profile%|%Duration%'
+PROBE_CACHE = '~/.cache/convert-videos-for-plex/probes.sqlite'
 
 
 class COLOR(str, Enum):
@@ -28,99 +63,282 @@ class COLOR(str, Enum):
     NC = '\033[0m'  # No Color
 
     def write(self, string: str, skip_time: bool = False) -> str:
-        return f'{self.value}{datetime.now().strftime("%b %d %H:%M:%S") + '\t' if not skip_time else ''}{string}{self.NC.value}'
+        if skip_time:
+            return f'{self.value}{string}{_NO_COLOR}'
+        # only reformat the timestamp when the second changes
+        now = int(time.time())
+        if now != _timestamp[0]:
+            _timestamp[:] = now, time.strftime('%b %d %H:%M:%S\t', time.localtime(now))
+        return f'{self.value}{_timestamp[1]}{string}{_NO_COLOR}'
+
+
+_NO_COLOR = COLOR.NC.value
+_timestamp = [0, '']
 
 
 class LockFile:
-    def __init__(self, file: 'File'):
-        self.lock_file = file.source.with_suffix('.lock')
-        self._touched = False
+    __slots__ = ('lock_file', 'stale_after', '_content', '_touched')
+
+    def __init__(self, file: 'File', stale_after: float | None = None):
+        self.lock_file: str = file.lock_path
+        self.stale_after: float | None = stale_after
+        self._content: str = ''
+        self._touched: bool = False
 
     def __enter__(self) -> 'LockFile':
         return self
 
-    def __exit__(self, exc_type, exc_val, exc_tb):
-        if self._touched:
-            self.lock_file.unlink()
+    def __exit__(self, exc_type, exc_val, exc_tb) -> None:
+        if not self._touched:
+            return
+        # after --stale_lock hours another run may have replaced the lock, that one is not ours to remove
+        try:
+            with open(self.lock_file) as lock:
+                content = lock.read()
+            if content == self._content:
+                os.unlink(self.lock_file)
+        except FileNotFoundError:
+            pass
 
     def exists(self) -> bool:
-        return self.lock_file.exists()
-
-    def touch(self):
-        self.lock_file.touch()
+        # stale locks do not count, they are only removed by touch() so a dry run never writes
+        return os.path.exists(self.lock_file) and not self._is_stale(self.lock_file, self.stale_after)
+
+    def touch(self) -> None:
+        try:
+            self._content = self._create(self.lock_file)
+        except FileExistsError:
+            if not self._break_stale():
+                raise
         self._touched = True
 
-    def __repr__(self):
+    @staticmethod
+    def _create(path: str) -> str:
+        # O_EXCL makes creating the lock atomic, raises FileExistsError if another process holds it
+        fd = os.open(path, os.O_CREAT | os.O_EXCL | os.O_WRONLY, 0o644)
+        content = f'{socket.gethostname()}\n{os.getpid()}\n{time.time()}\n'
+        try:
+            os.write(fd, content.encode())
+        finally:
+            os.close(fd)
+        return content
+
+    def _break_stale(self) -> bool:
+        # only one process at a time may check and replace a stale lock, otherwise two runs that both
+        # saw it stale could each remove the lock the other one just created
+        guard = self.lock_file + '.break'
+        try:
+            self._create(guard)
+        except FileExistsError:
+            # the guard is only held for a moment, one that is left behind by a crash is removed and retried once
+            if not self._is_stale(guard, LOCK_GUARD_TIMEOUT):
+                return False
+            try:
+                os.unlink(guard)
+                self._create(guard)
+            except (FileNotFoundError, FileExistsError):
+                return False
+        try:
+            if not self._is_stale(self.lock_file, self.stale_after):
+                return False
+            print(COLOR.RED.write(f"Removing stale lockfile '{os.path.basename(self.lock_file)}'"))
+            try:
+                os.unlink(self.lock_file)
+            except FileNotFoundError:
+                pass
+            self._content = self._create(self.lock_file)
+            return True
+        finally:
+            os.unlink(guard)
+
+    @staticmethod
+    def _is_stale(path: str, stale_after: float | None) -> bool:
+        try:
+            with open(path) as lock:
+                host, pid, created = (lock.read().split('\n') + ['', ''])[:3]
+        except FileNotFoundError:
+            return True
+        except OSError:
+            host, pid, created = '', '', ''
+        try:
+            age = time.time() - float(created)
+        except ValueError:
+            # locks from older versions are empty, only their age can be checked
+            try:
+                age = time.time() - os.path.getmtime(path)
+            except OSError:
+                return True
+        # the pid only means something on the machine that wrote it, the lock may be on a shared drive
+        dead = host == socket.gethostname() and pid.isdigit() and not pid_alive(int(pid))
+        return dead or bool(stale_after and age > stale_after)
+
+    def __repr__(self) -> str:
         return f'<LockFile {self.lock_file=} {self._touched=}>'
 
 
+class ProbeCache:
+    def __init__(self, path: str):
+        path = os.path.expanduser(path)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        # the check pool reads and writes from several threads, the lock serializes them on the one connection
+        self.lock = threading.Lock()
+        self.connection = sqlite3.connect(path, check_same_thread=False)
+        # WAL with synchronous=NORMAL makes each commit a cheap append instead of an fsync
+        self.connection.execute('PRAGMA journal_mode=WAL')
+        self.connection.execute('PRAGMA synchronous=NORMAL')
+        # version 1 added the parse speed, older tables are dropped and filled again
+        with self.connection:
+            if self.connection.execute('PRAGMA user_version').fetchone()[0] < 1:
+                self.connection.execute('DROP TABLE IF EXISTS probes')
+                self.connection.execute('PRAGMA user_version = 1')
+            self.connection.execute('CREATE TABLE IF NOT EXISTS probes (path TEXT PRIMARY KEY, mtime INTEGER, size INTEGER, parse_speed REAL, has_video INTEGER, format TEXT, profile TEXT, duration REAL)')
+
+    def load(self, file: 'File', parse_speed: float) -> bool:
+        stat = file.stat
+        # a header only probe does not give the duration a sort asking for a deeper parse needs
+        with self.lock:
+            row = self.connection.execute('SELECT has_video, format, profile, duration FROM probes WHERE path = ? AND mtime = ? AND size = ? AND parse_speed >= ?', (file.source_str, stat.st_mtime_ns, stat.st_size, parse_speed)).fetchone()
+        if not row:
+            return False
+        has_video, format, profile, duration = row
+        if has_video:
+            file.set_media_info(format, profile, duration)
+        else:
+            file.has_video = False
+        return True
+
+    def store(self, file: 'File', parse_speed: float) -> None:
+        # has_video stays None when the file could not be read, that is retried next run instead of remembered
+        if file.has_video is None:
+            return
+        stat = file.stat
+        try:
+            with self.lock, self.connection:
+                self.connection.execute('INSERT OR REPLACE INTO probes VALUES (?, ?, ?, ?, ?, ?, ?, ?)', (file.source_str, stat.st_mtime_ns, stat.st_size, parse_speed, file.has_video, file.format, file.profile, file.duration * MILLISEC_TO_MIN))
+        except sqlite3.Error:
+            # another run holding the database only costs a probe next time
+            pass
+
+    def close(self) -> None:
+        with self.lock:
+            self.connection.close()
+
+
 class File:
-    def __init__(self, source: Path, output: Path = None, force: bool = False):
-        self.source = source
-        self.dest = source.with_suffix('.mp4')
+    # one instance per discovered file is kept for the whole run
+    __slots__ = ('entry', 'source_str', 'name', 'extension', 'lock_path', 'dest_name', 'dest_str', 'skip', 'run', 'has_video', 'duration_min', 'duration', 'format', 'profile', 'force', '_source', '_dest', '_stat')
+
+    def __init__(self, source: Path | str, output: Path | None = None, force: bool = False, entry: os.DirEntry | None = None):
+        self.entry: os.DirEntry | None = entry
+        # paths are kept as strings, Path objects are only built for the callers that need them
+        self.source_str: str = os.fspath(source)
+        self.name: str = os.path.basename(self.source_str)
+        stem, extension = os.path.splitext(self.name)
+        self.extension: str = extension[1:].lower()
+        self.lock_path: str = os.path.splitext(self.source_str)[0] + '.lock'
+        self.dest_name: str = stem + '.mp4'
         if output:
-            self.dest = Path(output, self.dest.name)
-        self.skip = ''
-        self.run = False
-        self.media_info: MediaInfo = None
-        self.duration_min = 0.0
-        self.duration = 0
-        self.format = ''
-        self.profile = ''
-        self.force = force
+            self.dest_str: str = os.path.join(output, self.dest_name)
+        else:
+            self.dest_str = os.path.splitext(self.source_str)[0] + '.mp4'
+        self.skip: str = ''
+        self.run: bool = False
+        self.has_video: bool | None = None
+        self.duration_min: int = 0
+        self.duration: float = 0.0
+        self.format: str = ''
+        self.profile: str = ''
+        self.force: bool = force
+        self._source: Path | None = None
+        self._dest: Path | None = None
+        self._stat: os.stat_result | None = None
 
     def check_output_exists(self) -> 'File':
         if self.skip:
             return self
-        if self.dest.exists():
+        if os.path.exists(self.dest_str):
             if self.force:
-                self.skip = COLOR.RED.write(f"Overwriting: '{self.dest.name}'")
+                self.skip = COLOR.RED.write(f"Overwriting: '{self.dest_name}'")
             else:
-                self.skip = COLOR.RED.write(f"Skipping (already exists): '{self.dest.name}'")
+                self.skip = COLOR.RED.write(f"Skipping (already exists): '{self.dest_name}'")
         return self
 
     def get_duration(self) -> float:
-        if self.duration:
-            return self.duration
-        if not self.media_info:
-            self.media_info = MediaInfo.parse(self.source)
-        self.duration = float(self.media_info.video_tracks[0].duration or 0) / MILLISEC_TO_MIN
-        self.duration_min = math.ceil(self.duration / 10) * 10
+        if self.has_video is None:
+            self.read_media_info(parse_speed=0.5)
         return self.duration
 
-    def check_media_info(self, preset: str) -> tuple[str, bool]:
+    def read_media_info(self, parse_speed: float = 0.0) -> bool:
+        try:
+            if LibMediaInfo:
+                output = LibMediaInfo.read_metadata(self.source_str, ParseSpeed=str(parse_speed), Inform=MEDIAINFO_TEMPLATE)
+            else:
+                output = MediaInfo.parse(self.source, parse_speed=parse_speed, full=False, output=MEDIAINFO_TEMPLATE)
+        except FileNotFoundError:
+            # unreadable is not the same as having no video, so has_video stays unknown
+            return False
+        # one line per video track, the first one is used
+        line = next((line for line in output.splitlines() if line), '')
+        if not line:
+            self.has_video = False
+            return False
+        format, profile, duration = (line.split('|') + ['', ''])[:3]
+        try:
+            duration = float(duration)
+        except ValueError:
+            duration = 0
+        self.set_media_info(format, profile, duration)
+        return True
+
+    def set_media_info(self, format: str, profile: str, duration: float) -> 'File':
+        self.has_video = True
+        self.format = format or ''
+        self.profile = profile or ''
+        self.duration = float(duration or 0) / MILLISEC_TO_MIN
+        self.duration_min = math.ceil(self.duration / 10) * 10
+        return self
+
+    def check_media_info(self, preset: str, parse_speed: float = 0.0) -> tuple[str, bool]:
         if self.skip:
             return self.skip, self.run
-        if not self.media_info:
-            self.media_info = MediaInfo.parse(self.source)
-        if not self.media_info.video_tracks:
+        if self.extension in DISC_IMAGE_EXTENSIONS:
+            self.run = True
+            return self.skip, self.run
+        if self.has_video is None:
+            self.read_media_info(parse_speed)
+        if not self.has_video:
             self.skip = COLOR.RED.write(f"Skipping (missing info): '{self.name}'")
             return self.skip, self.run
-        self.format = self.media_info.video_tracks[0].format
-        self.profile = self.media_info.video_tracks[0].format_profile
-        if not self.duration_min:
-            self.get_duration()
-        match preset, self.format:
-            case 'H.265 VCN 1080p', 'HEVC':
-                pass
-            case 'Fast 1080p30', 'AVC':
-                pass
-            case _, _:
-                self.run = True
+        self.run = PRESET_FORMATS.get(preset) != self.format
         if not self.run:
             self.skip = COLOR.RED.write(f'Skipping (video format {self.format} {self.profile} already requested)')
         return self.skip, self.run
 
     @property
-    def name(self) -> str:
-        return self.source.name
+    def source(self) -> Path:
+        if self._source is None:
+            self._source = Path(self.source_str)
+        return self._source
 
-    def __repr__(self):
+    @property
+    def dest(self) -> Path:
+        if self._dest is None:
+            self._dest = Path(self.dest_str)
+        return self._dest
+
+    @property
+    def stat(self) -> os.stat_result:
+        if self._stat is None:
+            # DirEntry caches its stat, and on Windows it comes for free with the directory listing
+            self._stat = self.entry.stat() if self.entry else os.stat(self.source_str)
+        return self._stat
+
+    def __repr__(self) -> str:
         return f'<File {self.source=}>'
 
 
 class Converter:
-    def __init__(self, input: str = '.', output: str = None, run: bool = False, delete_original: bool = False, force: bool = False, audio_track: int = 0, subtitle_track: int = 0, preset: str = 'Fast 1080p30', sort_type: str = 'Name', sort_direction: str = 'ASC', extensions: Iterable[str] = None, exclude: Iterable[str] = None, stop_larger: bool = False):
+    def __init__(self, input: str = '.', output: str | None = None, run: bool = False, delete_original: bool = False, force: bool = False, audio_track: int = 0, subtitle_track: int = 0, preset: str = 'Fast 1080p30', sort_type: str = 'Name', sort_direction: str = 'ASC', extensions: Iterable[str] | None = None, exclude: Iterable[str] | None = None, stop_larger: bool = False, jobs: int = 1, workspace: str | None = None, probe_workers: int = min(32, (os.cpu_count() or 1) * 4), backend: str = 'handbrake', hw_device: str = '/dev/dri/renderD128', probe_cache: str | None = None, stale_lock: float | None = None, stall_timeout: int = 0):
         self.input = Path(input).resolve()
         self.output = Path(output).resolve() if output else None
         self.run = run
@@ -137,142 +355,478 @@ class Converter:
         if not exclude:
             exclude = []
         self.exclude = exclude
+        # a single alternation is searched once per path instead of once per pattern
+        self.exclude_re = re.compile('|'.join(f'(?:{pattern})' for pattern in exclude)) if exclude else None
         self.stop_larger = stop_larger
+        self.jobs = max(1, jobs)
+        self.workspace = Path(workspace).expanduser().resolve() if workspace else None
+        self.workspace_device = None
+        if self.workspace:
+            # TemporaryDirectory needs the workspace to exist, a dry run leaves it missing
+            try:
+                if self.run:
+                    self.workspace.mkdir(parents=True, exist_ok=True)
+                self.workspace_device = self.workspace.stat().st_dev
+            except FileNotFoundError:
+                pass
+            except OSError as e:
+                print(COLOR.RED.write(f"Cannot use workspace folder '{self.workspace}': {e.__repr__()}"))
+                exit(FATAL_ERROR)
+        self.output_device = None
+        if self.output:
+            # the encoders do not create the output folder, a dry run leaves it missing
+            try:
+                if self.run:
+                    self.output.mkdir(parents=True, exist_ok=True)
+                if self.workspace:
+                    self.output_device = self.output.stat().st_dev
+            except FileNotFoundError:
+                pass
+            except OSError as e:
+                print(COLOR.RED.write(f"Cannot use output folder '{self.output}': {e.__repr__()}"))
+                exit(FATAL_ERROR)
+        self.backend = backend
+        self.hw_device = hw_device
+        self.stale_lock = stale_lock * 3600 if stale_lock else None
+        self.stall_timeout = stall_timeout
         print(COLOR.BLUE.write("TRANSCODING" if self.run else "DRY RUN"))
-        self.check_pool = ProcessPoolExecutor(1)
+        self.probe_cache = None
+        if probe_cache:
+            try:
+                self.probe_cache = ProbeCache(probe_cache)
+            except (OSError, sqlite3.Error) as e:
+                print(COLOR.RED.write(f'Probe cache disabled: {e.__repr__()}'))
+        # probes are mostly waiting on disk or network and update each File in place, so threads scale
+        self.check_pool = ThreadPoolExecutor(max(1, probe_workers))
+        # encoder processes of the running jobs, so an interrupt can kill them
+        self.processes: set[subprocess.Popen] = set()
+        self.processes_lock = threading.Lock()
+        self.stopping = False
+        self.prefetch_pool = ThreadPoolExecutor(8)
 
     def get_files(self) -> list[tuple[File, Future]]:
         files = []
-        exts_len = len(self.extensions)
-        for i, ext in enumerate(self.extensions):
-            print(COLOR.BLUE.write(f'Finding files step {i + 1} of {exts_len} [{ext}]: '), end='', flush=True)
-            amount = len(files)
-            skipping = 0
-            for source in self.input.glob(f'**/*.{ext}'):
-                file = File(source, self.output, self.force).check_output_exists()
-                if not self.force and file.skip:
-                    skipping += 1
+        exts = dict.fromkeys(ext.lower() for ext in self.extensions)
+        found = dict.fromkeys(exts, 0)
+        skipping = dict.fromkeys(exts, 0)
+        print(COLOR.BLUE.write(f'Finding files in {self.input}'))
+        # one listing of the output folder instead of a stat per destination
+        existing = None
+        if not self.force:
+            existing = set()
+            if self.output:
+                try:
+                    with os.scandir(self.output) as listing:
+                        existing = {entry.path.casefold() for entry in listing if entry.is_file()}
+                except FileNotFoundError:
+                    pass
+        with ThreadPoolExecutor(WALK_WORKERS) as pool:
+            # without an output folder the destinations sit next to the sources, so the walk already lists them
+            entries = list(iter_video_files(self.input, frozenset(exts), self.exclude_re, pool, None if self.output else existing))
+        for entry, ext in entries:
+            if existing is not None:
+                stem = os.path.join(self.output, os.path.splitext(entry.name)[0]) if self.output else os.path.splitext(entry.path)[0]
+                # compared case-insensitively like exists() on Windows and macOS, so an existing Movie.MP4 is not overwritten
+                if stem.casefold() + '.mp4' in existing:
+                    skipping[ext] += 1
                     continue
-                files.append(file)
-            print(COLOR.GREEN.write(f'Found {len(files) - amount}', True) + (COLOR.RED.write(f'\tSkipping {skipping}', True) if skipping else ''))
+            file = File(entry.path, self.output, self.force, entry)
+            if existing is None:
+                file.check_output_exists()
+            if not self.force and file.skip:
+                skipping[ext] += 1
+                continue
+            found[ext] += 1
+            files.append(file)
+        for ext in exts:
+            print(COLOR.BLUE.write(f'[{ext}]: ') + COLOR.GREEN.write(f'Found {found[ext]}', True) + (COLOR.RED.write(f'\tSkipping {skipping[ext]}', True) if skipping[ext] else ''))
         print(COLOR.GREEN.write(f'Total: {len(files)}'))
-        files = map(lambda f: (f, self.check_pool.submit(file.check_media_info, self.preset)), files)
+        # the Duration sort needs the full probe, so it is done here instead of a second time in get_duration
+        parse_speed = 0.5 if self.sort_type in ('Duration', 'LPT') else 0.0
+        # unchanged files keep the result of an earlier run, only the rest are probed and then remembered
+        uncached = set(files)
+        if self.probe_cache:
+            uncached = {file for file in files if file.extension in DISC_IMAGE_EXTENSIONS or not self.probe_cache.load(file, parse_speed)}
+        reverse = self.sort_direction == 'DESC'
+        # sorts that do not need the probe are done first, so the probes and batches run in queue order
         match self.sort_type:
             case 'Name':
-                return sorted(files, key=lambda f: f[0].name, reverse=self.sort_direction == 'DESC')
-            case 'Duration':
-                return sorted(files, key=lambda f: f[0].get_duration(), reverse=self.sort_direction == 'DESC')
+                files.sort(key=lambda f: f.name, reverse=reverse)
             case 'Filesize':
-                return sorted(files, key=lambda f: f[0].source.stat().st_size, reverse=self.sort_direction == 'DESC')
+                files.sort(key=lambda f: f.stat.st_size, reverse=reverse)
             case 'Modified':
-                return sorted(files, key=lambda f: f[0].source.stat().st_mtime, reverse=self.sort_direction == 'DESC')
-        return sorted(files)
+                files.sort(key=lambda f: f.stat.st_mtime, reverse=reverse)
+        prefetched = self._prefetch_media_info([file for file in files if file in uncached], parse_speed)
+        pairs = [(f, self.check_pool.submit(self._check_media_info, f, parse_speed, f in uncached, prefetched.get(f))) for f in files]
+        match self.sort_type:
+            case 'Duration':
+                wait([future for _, future in pairs])
+                return sorted(pairs, key=lambda f: f[0].get_duration(), reverse=reverse)
+            case 'LPT':
+                # longest expected encode first so parallel jobs do not end waiting on one straggler
+                wait([future for _, future in pairs])
+                return sorted(pairs, key=lambda f: f[0].get_duration() * FORMAT_COMPLEXITY.get(f[0].format, 0.5), reverse=True)
+        return pairs
+
+    def _check_media_info(self, file: File, parse_speed: float, store: bool, prefetch: Future | None = None) -> tuple[str, bool]:
+        if prefetch:
+            # files the batch did not fill in, or that it never got to, are probed on their own
+            wait([prefetch])
+        result = file.check_media_info(self.preset, parse_speed)
+        if store and self.probe_cache:
+            self.probe_cache.store(file, parse_speed)
+        return result
+
+    def _prefetch_media_info(self, files: list[File], parse_speed: float) -> dict[File, Future]:
+        mediainfo = shutil.which('mediainfo')
+        files = [file for file in files if file.extension not in DISC_IMAGE_EXTENSIONS]
+        if not mediainfo or not files:
+            return {}
+        # batches follow the queue order, consecutive files of one directory share a batch
+        batches: list[list[File]] = []
+        for file in files:
+            if batches and len(batches[-1]) < MEDIAINFO_BATCH and os.path.dirname(batches[-1][0].source_str) == os.path.dirname(file.source_str):
+                batches[-1].append(file)
+            else:
+                batches.append([file])
+        print(COLOR.BLUE.write(f'Reading media info for {len(files)} files'))
+        # batches run in the background, each check only waits for its own so encodes start before the whole library is read
+        prefetched = {}
+        for batch in batches:
+            prefetched.update(dict.fromkeys(batch, self.prefetch_pool.submit(self._read_media_info, mediainfo, batch, parse_speed)))
+        return prefetched
 
     @staticmethod
-    def get_handbrake_command():
-        if hasattr(Converter.get_handbrake_command, 'command'):
-            return Converter.get_handbrake_command.command
-        command = 'HandBrakeCLI'
-        if sys.platform == 'win32':
-            command += '.exe'
-            for path in [Path('.').resolve()] + os.path.expandvars('$PATH').split(';'):
-                if Path(path, command).exists():
-                    break
-            else:
-                print(COLOR.RED.write(f'{command} not found, downloading'))
-                version = requests.get('https://github.com/HandBrake/HandBrake/releases/latest').url.split('/')[-1]
-                ZipFile(BytesIO(requests.get(f'https://github.com/HandBrake/HandBrake/releases/download/{version}/HandBrakeCLI-{version}-win-x86_64.zip').content)).extract('HandBrakeCLI.exe')
-        else:
-            for path in os.path.expandvars('$PATH').split(';'):
-                if Path(path, command).exists():
-                    break
-            else:
-                try:
-                    subprocess.run(['HandBrakeCLI'], check=True, capture_output=True)
-                except subprocess.CalledProcessError:
-                    print(COLOR.RED.write('HandBrakeCLI is not installed, please install it using the instructions in the README.md'))
-                    exit(FATAL_ERROR)
-        Converter.get_handbrake_command.command = command
+    def _read_media_info(mediainfo: str, files: list[File], parse_speed: float) -> None:
+        try:
+            output = os.fsdecode(subprocess.run([mediainfo, f'--ParseSpeed={parse_speed}', f'--Inform={MEDIAINFO_BATCH_TEMPLATE}', *(file.source_str for file in files)], capture_output=True, check=True).stdout)
+        except (OSError, subprocess.CalledProcessError):
+            return
+        for line in output.splitlines():
+            # matched by prefix since a path may itself contain |
+            file = next((file for file in files if line.startswith(file.source_str) and line[len(file.source_str):len(file.source_str) + 1] in ('', '|')), None)
+            if not file or file.has_video is not None:
+                continue
+            tracks = line[len(file.source_str) + 1:]
+            if not tracks:
+                file.has_video = False
+                continue
+            format, profile, duration = (tracks.split('|') + ['', ''])[:3]
+            try:
+                file.set_media_info(format, profile, float(duration))
+            except ValueError:
+                file.set_media_info(format, profile, 0)
+
+    @staticmethod
+    @cache
+    def get_handbrake_command() -> str:
+        command = shutil.which('HandBrakeCLI')
+        if not command:
+            if sys.platform != 'win32':
+                print(COLOR.RED.write('HandBrakeCLI is not installed, please install it using the instructions in the README.md'))
+                exit(FATAL_ERROR)
+            print(COLOR.RED.write('HandBrakeCLI.exe not found, downloading'))
+            with urlopen('https://github.com/HandBrake/HandBrake/releases/latest') as response:
+                version = response.url.split('/')[-1]
+            # stream the zip to disk instead of holding it in memory
+            with urlopen(f'https://github.com/HandBrake/HandBrake/releases/download/{version}/HandBrakeCLI-{version}-win-x86_64.zip') as response, TemporaryFile() as archive:
+                shutil.copyfileobj(response, archive, 1 << 20)
+                command = ZipFile(archive).extract('HandBrakeCLI.exe')
+        return command
+
+    @staticmethod
+    @cache
+    def get_ffmpeg_command(encoder: str) -> str:
+        command = shutil.which('ffmpeg')
+        if not command:
+            print(COLOR.RED.write('ffmpeg is not installed, it is required for hardware encoding'))
+            exit(FATAL_ERROR)
+        encoders = subprocess.run([command, '-hide_banner', '-encoders'], capture_output=True).stdout.decode(errors='replace')
+        if f' {encoder} ' not in encoders:
+            print(COLOR.RED.write(f'ffmpeg was built without the {encoder} encoder'))
+            exit(FATAL_ERROR)
         return command
 
-    def convert(self):
-        audio = ['--audio', self.audio_track] if self.audio_track != 0 else ['--all-audio']
-        subtitle = ['--subtitle', self.subtitle_track, '--subtitle_burned'] if self.subtitle_track != 0 else ['-s', 'scan']
+    def get_command_args(self, backend: str | None = None) -> tuple[tuple[str, ...], tuple[str, ...]]:
+        # arguments before and after the input, the output path is appended last
+        backend = backend or self.backend
+        if backend == 'handbrake':
+            audio = ('--audio', str(self.audio_track)) if self.audio_track != 0 else ('--all-audio',)
+            subtitle = ('--subtitle', str(self.subtitle_track), '--subtitle_burned') if self.subtitle_track != 0 else ('-s', 'scan')
+            return (self.get_handbrake_command(), '--preset', self.preset, '-O', *subtitle, *audio), ('-o',)
+        encoder = f"{'hevc' if PRESET_FORMATS.get(self.preset) == 'HEVC' else 'h264'}_{backend}"
+        if self.subtitle_track != 0:
+            print(COLOR.RED.write(f'Burning in subtitles is only supported by HandBrake, ignoring subtitle track {self.subtitle_track}'))
+        hwaccel: tuple[str, ...]
+        quality: tuple[str, ...]
+        # the hardware backends follow the resolution and frame rate cap in the preset name, without upscaling
+        scale = fps = ''
+        if size := PRESET_SIZE_RE.search(self.preset):
+            height = int(size[1])
+            factor = f'min(1,min({height * 16 // 9}/iw,{height}/ih))'
+            scale = f"w='trunc(iw*{factor}/2)*2':h='trunc(ih*{factor}/2)*2'"
+            fps = size[2] or ''
+        video_filter: tuple[str, ...] = ()
+        match backend:
+            case 'nvenc':
+                hwaccel = ('-hwaccel', 'cuda', '-hwaccel_output_format', 'cuda')
+                quality = ('-preset', 'p5')
+                if scale:
+                    video_filter = ('-vf', f'scale_cuda={scale}')
+            case 'qsv':
+                hwaccel = ('-hwaccel', 'qsv', '-hwaccel_output_format', 'qsv', '-qsv_device', self.hw_device)
+                quality = ('-preset', 'medium')
+                if scale:
+                    video_filter = ('-vf', f'scale_qsv={scale}')
+            case _:
+                hwaccel = ('-hwaccel', 'vaapi', '-hwaccel_output_format', 'vaapi', '-vaapi_device', self.hw_device)
+                quality = ()
+                # frames the GPU cannot decode arrive in system memory and have to be uploaded first
+                video_filter = ('-vf', 'format=nv12|vaapi,hwupload' + (f',scale_vaapi={scale}' if scale else ''))
+        audio = ('-map', f'0:a:{self.audio_track - 1}') if self.audio_track != 0 else ('-map', '0:a?')
+        return (self.get_ffmpeg_command(encoder), '-hide_banner', '-nostats', '-progress', 'pipe:1', '-y', *hwaccel), ('-map', '0:v:0', *audio, *video_filter, *(('-fpsmax', fps) if fps else ()), '-c:v', encoder, *quality, '-b:v', FFMPEG_BITRATE, '-c:a', 'aac', '-sn', '-movflags', '+faststart')
+
+    def _transcode_one(self, file: File, args: tuple[tuple[str, ...], tuple[str, ...]]) -> tuple[File, float, int, int] | None:
+        with LockFile(file, self.stale_lock) as lock, TemporaryDirectory(dir=self.workspace) if self.workspace else nullcontext() as workspace:
+            try:
+                lock.touch()
+            except FileExistsError:
+                print(COLOR.RED.write(f"Lockfile for '{file.name}' exists, skipping"))
+                return None
+            start = timeit.default_timer()
+            source, dest = file.source, file.dest
+            if workspace:
+                source, dest = Path(workspace, file.name), Path(workspace, file.dest_name)
+                # DirEntry.stat() reports st_dev as 0 on Windows, so the device needs a real stat
+                device = os.stat(file.source_str).st_dev
+                # a hard link is free and safe since the staged source is only read and then removed
+                fast_copy(file.source, source, device == self.workspace_device)
+            # progress is parsed from stdout, only the tail of stderr is kept for error messages
+            before, after = args
+            process = subprocess.Popen([*before, '-i', source, *after, dest], stdout=subprocess.PIPE, stderr=subprocess.PIPE, bufsize=65536)
+            assert process.stdout and process.stderr
+            with self.processes_lock:
+                self.processes.add(process)
+                if self.stopping:
+                    process.kill()
+            stderr: deque[bytes] = deque(maxlen=STDERR_LINES)
+            reader = threading.Thread(target=stderr.extend, args=(process.stderr,), daemon=True)
+            reader.start()
+            progress = [0.0, timeit.default_timer()]
+            progress_reader = threading.Thread(target=read_progress, args=(process.stdout, progress, file.duration * 60), daemon=True)
+            progress_reader.start()
+            stalled = False
+            try:
+                printed = timeit.default_timer()
+                while True:
+                    try:
+                        process.wait(1)
+                        break
+                    except subprocess.TimeoutExpired:
+                        pass
+                    now = timeit.default_timer()
+                    # a hung encoder never exits on its own, but muxing and the faststart rewrite after the
+                    # last percent print nothing for as long as it takes to write the whole file again
+                    if self.stall_timeout and progress[0] < 99 and now - progress[1] > self.stall_timeout:
+                        stalled = True
+                        process.kill()
+                        process.wait()
+                        break
+                    if now - printed >= PROGRESS_INTERVAL:
+                        printed = now
+                        eta = f' [ETA: {calc_time((now - start) / progress[0] * (100 - progress[0]))}]' if progress[0] else ''
+                        print(COLOR.BLUE.write(f"Progress: '{file.name}' {progress[0]:.1f}%{eta}"))
+            except BaseException:
+                process.kill()
+                process.wait()
+                if dest.exists():
+                    dest.unlink()
+                raise
+            finally:
+                with self.processes_lock:
+                    self.processes.discard(process)
+            reader.join()
+            progress_reader.join()
+            process.stderr.close()
+            process.stdout.close()
+            if stalled:
+                if dest.exists():
+                    dest.unlink()
+                print(COLOR.RED.write(f"{os.path.basename(before[0])} made no progress on '{file.name}' for {self.stall_timeout}s, killed it"))
+                return None
+            if process.returncode:
+                if dest.exists():
+                    dest.unlink()
+                if self.stopping:
+                    return None
+                print(COLOR.RED.write(f'{os.path.basename(before[0])} exited with code [{process.returncode}] and stderr: {b"".join(stderr).decode(errors="replace")}'))
+                return None
+            if workspace:
+                try:
+                    # on the same filesystem the output only needs to be renamed into place
+                    if (self.output_device if self.output else device) == self.workspace_device:
+                        os.replace(dest, file.dest)
+                    else:
+                        fast_copy(dest, file.dest)
+                except BaseException:
+                    if file.dest.exists():
+                        file.dest.unlink()
+                    raise
+            return file, timeit.default_timer() - start, file.stat.st_size, file.dest.stat().st_size
+
+    def _finish_transcode(self, future: Future, time_avg: dict[int, tuple[float, int]], queue_data: dict[str, float]) -> bool:
+        result = future.result()
+        if not result:
+            return True
+        file, time, original_size, new_size = result
+        total, runs = time_avg.get(file.duration_min, (0.0, 0))
+        time_avg[file.duration_min] = total + time, runs + 1
+        queue_data['times'] += time
+        queue_data['durations'] += file.duration
+        queue_data['count'] += 1
+        print(COLOR.GREEN.write(f'Transcoded [{calc_time(time)}]: {file.dest_name} [{new_size / original_size:03.2%}]'))
+        if self.stop_larger and new_size > original_size:
+            print(COLOR.RED.write('Output > Input: STOPPING'))
+            file.dest.unlink()
+            return False
+        if self.delete_original:
+            file.source.unlink()
+        return True
+
+    def _stop_encodes(self) -> None:
+        with self.processes_lock:
+            self.stopping = True
+            for process in self.processes:
+                process.kill()
+
+    def convert(self) -> None:
         files = self.get_files()
         count = len(files)
         count_len = len(str(count))
-        time_avg = {}
-        command = self.get_handbrake_command()
-        queue_data = {'times': [], 'durations': []}
-        for i, (file, checking_info) in enumerate(files):
-            if file.skip and not self.force:
-                print(file.skip)
-                checking_info.cancel()
+        time_avg: dict[int, tuple[float, int]] = {}
+        args = self.get_command_args()
+        # ffmpeg cannot open DVD images, so those always go through HandBrake
+        disc_args = args if self.backend == 'handbrake' else self.get_command_args('handbrake') if shutil.which('HandBrakeCLI') else None
+        # running (sum, count) totals so the averages are O(1) to read
+        queue_data: dict[str, float] = {'times': 0.0, 'durations': 0.0, 'count': 0}
+        running: set[Future] = set()
+        with ThreadPoolExecutor(self.jobs) as pool:
+            try:
+                for i, (file, checking_info) in enumerate(files):
+                    if LockFile(file, self.stale_lock).exists():
+                        print(COLOR.RED.write(f"Lockfile for '{file.name}' exists, skipping"))
+                        continue
+                    eta = ''
+                    if queue_data['count'] >= 2:
+                        duration = math.ceil(queue_data['durations'] / queue_data['count'] / 10) * 10
+                        total, runs = time_avg.get(duration, (queue_data['times'], queue_data['count']))
+                        eta = f' [Queue ETA: {calc_time(total / runs * (count - i) / self.jobs)}]'
+                    i += 1
+                    print(COLOR.BLUE.write(f"Checking [{i:0{count_len}}/{count} ({i/count:.0%})]: '{file.name}'{eta}"))
+                    try:
+                        file.skip, file.run = checking_info.result()
+                    except RuntimeError as e:
+                        print(COLOR.RED.write(f'ERROR: {e.__repr__()}'))
+                        continue
+                    run_args = disc_args if file.extension in DISC_IMAGE_EXTENSIONS else args
+                    if file.run and not run_args:
+                        print(COLOR.RED.write(f"Skipping (disc images need HandBrakeCLI): '{file.name}'"))
+                        continue
+                    if file.run and run_args:
+                        eta = ''
+                        duration = file.duration_min
+                        total, runs = time_avg.get(duration, (0.0, 0))
+                        if runs >= 2:
+                            eta = f' [ETA: {calc_time(total / runs)}]'
+                        print(COLOR.BLUE.write(f"Transcoding: '{file.name}' to '{file.dest_name}'{eta}"))
+                        if self.run:
+                            running.add(pool.submit(self._transcode_one, file, run_args))
+                            if len(running) < self.jobs:
+                                continue
+                            done, running = wait(running, return_when=FIRST_COMPLETED)
+                            if not all([self._finish_transcode(future, time_avg, queue_data) for future in done]):
+                                pool.shutdown(cancel_futures=True)
+                                break
+                        else:
+                            print(COLOR.GREEN.write(f'Transcoded (DRY RUN): {file.dest_name}'))
+                    elif file.skip:
+                        print(file.skip)
+                for future in as_completed(running):
+                    self._finish_transcode(future, time_avg, queue_data)
+            except BaseException:
+                # Ctrl+C only reaches this thread, the encoders running on the pool have to be stopped from here
+                self._stop_encodes()
+                pool.shutdown(wait=False, cancel_futures=True)
+                self.prefetch_pool.shutdown(wait=False, cancel_futures=True)
+                self.check_pool.shutdown(wait=False, cancel_futures=True)
+                raise
+        self.prefetch_pool.shutdown(cancel_futures=True)
+        self.check_pool.shutdown(cancel_futures=True)
+        if self.probe_cache:
+            self.probe_cache.close()
+
+
+def fast_copy(source: Path, dest: Path, hardlink: bool = False) -> None:
+    if hardlink:
+        try:
+            os.link(source, dest)
+            return
+        except OSError:
+            pass
+    # copy-on-write clones are a metadata only operation on filesystems that support them (Btrfs, XFS, APFS, ZFS)
+    if sys.platform == 'darwin':
+        try:
+            if ctypes.CDLL('/usr/lib/libSystem.dylib', use_errno=True).clonefile(os.fsencode(source), os.fsencode(dest), 0) == 0:
+                return
+        except (OSError, AttributeError):
+            pass
+    elif hasattr(os, 'copy_file_range'):
+        # in-kernel copy on Linux, which also reflinks where the filesystem supports it
+        try:
+            with open(source, 'rb') as src, open(dest, 'wb') as dst:
+                while os.copy_file_range(src.fileno(), dst.fileno(), 1 << 30):
+                    pass
+            return
+        except OSError:
+            pass
+    shutil.copyfile(source, dest)
+
+
+def scandir(path: Path | str) -> Iterator[os.DirEntry]:
+    # folders like lost+found or System Volume Information are not readable and should not end the whole walk
+    try:
+        with os.scandir(path) as entries:
+            return iter(list(entries))
+    except OSError as e:
+        print(COLOR.RED.write(f"Skipping (cannot read folder): '{path}' {e.__repr__()}"))
+        return iter(())
+
+
+def iter_video_files(root: Path | str, exts: frozenset[str], exclude: re.Pattern | None = None, pool: ThreadPoolExecutor | None = None, outputs: set[str] | None = None) -> Iterator[tuple[os.DirEntry, str]]:
+    stack = [scandir(root)]
+    subtrees = []
+    while stack:
+        for entry in stack[-1]:
+            _, dot, ext = entry.name.rpartition('.')
+            ext = ext.lower()
+            # existing outputs count even when excluded, so they are never overwritten without -f
+            if outputs is not None and dot and ext == 'mp4':
+                outputs.add(entry.path.casefold())
+            if exclude and exclude.search(entry.path):
                 continue
-            with LockFile(file) as lock:
-                if lock.exists():
-                    print(COLOR.RED.write(f"Lockfile for '{file.name}' exists, skipping"))
-                    continue
-                if self.run:
-                    lock.touch()
-                eta = ''
-                if len(queue_data['times']) >= 2:
-                    duration = math.ceil(mean(queue_data['durations']) / 10) * 10
-                    for dur, avg in time_avg.items():
-                        if dur == duration:
-                            avg = mean(avg)
-                            break
-                    else:
-                        avg = mean(queue_data['times'])
-                    eta = f' [Queue ETA: {calc_time(avg * (count - i))}]'
-                i += 1
-                print(COLOR.BLUE.write(f"Checking [{i:0{count_len}}/{count} ({i/count:.0%})]: '{file.name}'{eta}"))
-                if file.skip and not self.force:
-                    print(file.skip)
-                    checking_info.cancel()
+            if entry.is_dir(follow_symlinks=False):
+                if pool:
+                    # walk each top level folder on its own thread to overlap filesystem (network share) latency
+                    subtrees.append(pool.submit(list, iter_video_files(entry.path, exts, exclude, outputs=outputs)))
                     continue
-                try:
-                    file.skip, file.run = checking_info.result()
-                except RuntimeError as e:
-                    print(COLOR.RED.write(f'ERROR: {e.__repr__()}'))
-                    continue
-                if file.run:
-                    eta = ''
-                    duration = file.duration_min
-                    if len(time_avg.get(duration, [])) >= 2:
-                        eta = f' [ETA: {calc_time(mean(time_avg[duration]))}]'
-                    print(COLOR.BLUE.write(f"Transcoding: '{file.name}' to '{file.dest.name}'{eta}"))
-                    if self.run:
-                        start = timeit.default_timer()
-                        try:
-                            subprocess.run([command, '-i', file.source, '-o', file.dest, '--preset', self.preset, '-O'] + subtitle + audio, capture_output=True, check=True)
-                        except BaseException as e:
-                            if file.dest.exists():
-                                file.dest.unlink()
-                            if not isinstance(e, subprocess.CalledProcessError):
-                                raise e
-                            print(COLOR.RED.write(f'HandBrakeCLI exited with code [{e.returncode}] and stderr: {e.stderr.decode()}'))
-                            continue
-                        time = timeit.default_timer() - start
-                        try:
-                            time_avg[duration].append(time)
-                        except KeyError:
-                            time_avg[duration] = [time]
-                        queue_data['times'].append(time)
-                        queue_data['durations'].append(file.duration)
-                        original_size = file.source.stat().st_size
-                        new_size = file.dest.stat().st_size
-                        print(COLOR.GREEN.write(f'Transcoded [{calc_time(time)}]: {file.dest.name} [{new_size / original_size:03.2%}]'))
-                        if self.stop_larger and new_size > original_size:
-                            print(COLOR.RED.write('Output > Input: STOPPING'))
-                            file.dest.unlink()
-                            break
-                        if self.delete_original:
-                            file.source.unlink()
-                    else:
-                        print(COLOR.GREEN.write(f'Transcoded (DRY RUN): {file.dest.name}'))
-                elif file.skip:
-                    print(file.skip)
+                stack.append(scandir(entry.path))
+                break
+            if dot and ext in exts:
+                yield entry, ext
+        else:
+            stack.pop()
+    for subtree in subtrees:
+        yield from subtree.result()
 
 
 def cli() -> Converter:
@@ -296,16 +850,67 @@ def cli() -> Converter:
     parser.add_argument('-i', '--input', default='.', help='The directory path of the videos to be tidied [.]', metavar='PATH', dest='input')
     parser.add_argument('-p', '--preset', default='Fast 1080p30', help='Quality of HandBrake encoding preset. List of presets: https://handbrake.fr/docs/en/latest/technical/official-presets.html [Fast 1080p30]', metavar='PRESET', dest='preset')
     parser.add_argument('-r', '--run', action='store_true', help='Run transcoding. Exclude for dry run', dest='run')
-    parser.add_argument('--sort_type', default='Name', help='Run in sort order [Name]', choices=['Name', 'Duration', 'Filesize', 'Modified'], dest='sort_type')
+    parser.add_argument('--sort_type', default='Name', help='Run in sort order. LPT runs the longest expected encodes first, ignoring sort_direction [Name]', choices=['Name', 'Duration', 'Filesize', 'Modified', 'LPT'], dest='sort_type')
     parser.add_argument('--sort_direction', default='DESC', help='Sort direction [DESC]', choices=['ASC', 'DESC'], dest='sort_direction')
-    parser.add_argument('-e', '--extensions', help='File extensions to check [avi, mkv, iso, img, m4v, ts]', action='extend', dest='extensions')
-    parser.add_argument('--exclude', help='Files or directories to exclude (regex)', action='extend', dest='exclude', metavar='FILE_DIR_REGEX')
+    parser.add_argument('-e', '--extensions', help='File extensions to check [avi, mkv, iso, img, m4v, ts]', action='extend', nargs='+', metavar='EXT', dest='extensions')
+    parser.add_argument('--exclude', help='Files or directories to exclude (regex)', action='extend', nargs='+', dest='exclude', metavar='FILE_DIR_REGEX')
     parser.add_argument('-f', action='store_true', help='Force overwriting of files if already exist in output destination', dest='force')
     parser.add_argument('--stop_larger', help='Quit if output is larger than input (should only use if sort_type=Filesize)', action='store_true', dest='stop_larger')
+    parser.add_argument('-j', '--jobs', default=1, help='Number of files to transcode at the same time [1]', type=int, metavar='JOBS', dest='jobs')
+    parser.add_argument('-w', '--workspace', default=None, help='Workspace directory path for processing. Set a local directory for faster transcoding over network [None]', metavar='WORKSPACE', dest='workspace')
+    parser.add_argument('--stall_timeout', default=0, help='Kill an encode that prints no new progress for this many seconds before it is finished, 0 to never kill [0]', type=int, metavar='SECONDS', dest='stall_timeout')
+    parser.add_argument('--stale_lock', default=None, help='Hours after which a lock file is treated as left behind by a crashed run. Locks of dead processes on this machine are always removed [Never]', type=float, metavar='HOURS', dest='stale_lock')
+    parser.add_argument('--probe_workers', default=min(32, (os.cpu_count() or 1) * 4), help='Number of files to read media info from at the same time [CPUs * 4, max 32]', type=int, metavar='WORKERS', dest='probe_workers')
+    parser.add_argument('--probe_cache', default=PROBE_CACHE, help=f'Database that keeps media info of unchanged files between runs, empty to disable [{PROBE_CACHE}]', metavar='PATH', dest='probe_cache')
+    parser.add_argument('--backend', default='handbrake', help='Encode with HandBrake or with ffmpeg using a hardware encoder, which only takes the resolution and frame rate cap from the preset name and encodes at a fixed bitrate [handbrake]', choices=['handbrake', 'nvenc', 'qsv', 'vaapi'], dest='backend')
+    parser.add_argument('--hw_device', default='/dev/dri/renderD128', help='Device used by the qsv and vaapi backends [/dev/dri/renderD128]', metavar='DEVICE', dest='hw_device')
     return Converter(**parser.parse_args().__dict__)
 
 
-def calc_time(seconds: int | float):
+def read_progress(stream: IO[bytes], progress: list[float], seconds: float) -> None:
+    # progress is [percent done, time of the last new output line]
+    last = b''
+    buffer = b''
+    fd = stream.fileno()
+    for chunk in iter(lambda: os.read(fd, 65536), b''):
+        # HandBrake redraws its progress line with carriage returns instead of newlines
+        *lines, buffer = re.split(rb'[\r\n]', buffer + chunk)
+        for line in lines:
+            if not line or line == last:
+                continue
+            last = line
+            progress[1] = timeit.default_timer()
+            match = PROGRESS_RE.search(line)
+            if not match:
+                continue
+            if match[1]:
+                progress[0] = float(match[1])
+            elif seconds:
+                progress[0] = min(100.0, int(match[2]) / 1e6 / seconds * 100)
+
+
+def pid_alive(pid: int) -> bool:
+    if sys.platform == 'win32':
+        # os.kill would terminate the process on Windows, so ask for its exit code instead
+        kernel32 = ctypes.WinDLL('kernel32', use_last_error=True)
+        handle = kernel32.OpenProcess(0x1000, False, pid)  # PROCESS_QUERY_LIMITED_INFORMATION
+        if not handle:
+            return ctypes.get_last_error() == 5  # ERROR_ACCESS_DENIED, it exists but belongs to someone else
+        code = ctypes.c_ulong()
+        try:
+            return bool(kernel32.GetExitCodeProcess(handle, ctypes.byref(code))) and code.value == 259  # STILL_ACTIVE
+        finally:
+            kernel32.CloseHandle(handle)
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
+
+
+def calc_time(seconds: int | float) -> str:
     seconds = int(seconds)
     minutes = seconds % 60
     hours = seconds // 3600